@@ -1,11 +1,13 @@
 import asyncio
+import io
 import mimetypes
 import logging
-import operator
 import os
 import re
-import requests
-from functools import reduce
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 import aiohttp
 
 import discord
@@ -18,24 +20,160 @@ from line.models import (FlexSendMessage, BubbleContainer, FillerComponent, BoxC
 logger = logging.getLogger(__name__)
 
 def group(list, group_size):
-    """ Splits the given array into an array of subarrays,
+    """ Splits the given array into subarrays, yielded one at a time,
         with each subarray having at most group_size many elements.
     """ 
-    return [ list[start_idx:start_idx + group_size] for start_idx in range(0, len(list), group_size) ]
+    if 0 < len(list) <= group_size:
+        # the array fits in one group, no need to slice it
+        yield list
+        return
+
+    for start_idx in range(0, len(list), group_size):
+        yield list[start_idx:start_idx + group_size]
+
+""" Regex that matches an emoji string, in its text form.
+
+    An emoji is of the form: <:(emoji name):(emoji hash)>.
+    For example, <:crown:408166031022882816> is a valid emoji
+
+    Captures the emoji hash.
+
+    Discord seems to sanitize messages so we don't have to worry about 
+    having message content in this form but is not an emoji.
+"""
+emoji_regex = re.compile(r'<:[^:]+:([0-9]+)>', re.ASCII)
+
+def find_plain_emojis(content):
+    """ Returns the emoji hashes of a message with just emojis, in its text form,
+        or an empty list if the message is not such a message.
+
+        A message that contains just emojis is a message such that there is no
+        non-emoji text in the content, except whitespaces.
+        For example, "<:rock:408166560826654730> <:crown:408166031022882816>"
+        is such a message.
+
+        The content is scanned once, checking the text between emojis as we go.
+    """
+    emojis = []
+    previous_end = 0
+    for match in emoji_regex.finditer(content):
+        if content[previous_end:match.start()].strip():
+            return []
+        emojis.append(match.group(1))
+        previous_end = match.end()
+
+    if content[previous_end:].strip():
+        return []
+    return emojis
+
+""" Regex that matches a url.
+
+    This is needed since URLs sent in a flex message will not appear in
+    Line as a clickable link, nor is it copiable, which is extremely
+    inconvenient as the user will eventually need to open Discord to open
+    the link, which defeats the whole purpose of the bot.
+
+    Credits goes to gruber @ https://gist.github.com/gruber/8891611
+"""
+# top level domains of bare URLs such as example.com/, listed once and used twice in url_regex
+url_tlds = 'com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw'
+url_regex = re.compile(r'''(?i)\b((?:https?:(?:/{{1,3}}|[a-z0-9%])|[a-z0-9.\-]+[.](?:{tlds})/)(?:[^\s()<>{{}}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{{}};:'".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:{tlds})\b/?(?!@)))'''.format(tlds=url_tlds))
+
+""" Regex that matches the scheme of a url, used to rule out messages
+    without any url before running url_regex.
+"""
+url_scheme_regex = re.compile(r'https?:', re.IGNORECASE | re.ASCII)
+
+def find_urls(content):
+    """ Returns all URLs found in content.
+
+        Every string url_regex matches contains either a '.' or 'http:'/'https:',
+        so most chat messages can skip the (very large) regex entirely.
+    """
+    if '.' not in content and not url_scheme_regex.search(content):
+        return []
+    return url_regex.findall(content)
+
+""" Mimetypes of the file extensions most commonly attached in Discord,
+    looked up directly without going through the mimetypes module.
+"""
+common_mimetypes = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.webp': 'image/webp',
+    '.mp4': 'video/mp4', '.webm': 'video/webm',
+    '.mp3': 'audio/mpeg', '.m4a': 'audio/mp4', '.wav': 'audio/x-wav', '.ogg': 'audio/ogg',
+}
+
+@lru_cache(maxsize=256)
+def guess_mimetype(extension):
+    """ Guesses the mimetype of a file from its lowercased extension, e.g. '.png'.
+        Returns None if the mimetype cannot be guessed.
+    """
+    return (common_mimetypes.get(extension) or mimetypes.types_map.get(extension) or
+            mimetypes.guess_type('x' + extension)[0])
+
+@lru_cache(maxsize=512)
+def author_name_component(display_name, color):
+    """ One line of string (no wrap) that has the author name
+        with a color as displayed in Discord.
+    """
+    return TextComponent(text=display_name, weight='bold', flex=0, color=color, size='sm')
+
+@lru_cache(maxsize=512)
+def avatar_component(author_id, avatar_hash, default_avatar_url):
+    """ Image of the author's avatar.
+        default_avatar_url is only used when the author has no avatar_hash.
+    """
+    # NOTE: avatar_url gives a webp format which Line doesn't know how to deal with.
+    #       Let's just guess the png file name from the user id and avatar hash.
+    #       default_avatar_url is a png so no guessing is needed.
+    url = (default_avatar_url if not avatar_hash else
+           'https://cdn.discordapp.com/avatars/{}/{}.png?size=256'.format(author_id, avatar_hash))
+    return ImageComponent(url=url, flex=0, size='xxs')
+
+@lru_cache(maxsize=2048)
+def emoji_icon_component(emoji, size):
+    """ Icon of the emoji with the given hash.
+        Cached since the same server emojis are sent over and over again.
+    """
+    return IconComponent(url='https://cdn.discordapp.com/emojis/{}.png'.format(emoji), size=size)
 
 class TwitchBroadcastAnnouncer:
     @staticmethod
-    def subscribe(user_name):
-        response = requests.post(os.environ['TWITCH_SUBSCRIBE_URL'], data={ 'user_name' : user_name })
+    async def subscribe(session, user_name):
         try:
-            response.raise_for_status()
-        except:
-            logger.error('Unable to subscribe for Twitch user {}'.format(user_name))
+            async with session.post(os.environ['TWITCH_SUBSCRIBE_URL'], data={ 'user_name' : user_name }) as response:
+                response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.error('Unable to subscribe for Twitch user %s', user_name)
 
 class LineCarbot:
     token = os.environ['LINE_TOKEN']
     api = LineBotApi(token)
     target_group_id = os.environ['LINE_TARGET_GROUP_ID']
+    # LineBotApi is blocking, so calls to it are run on this executor instead of the event loop.
+    # A single worker makes pushes go out in the order they were submitted,
+    # which keeps messages in Line in the same order as in Discord.
+    executor = ThreadPoolExecutor(max_workers=1)
+    # pushes failing with these status codes are worth retrying, as they are usually transient
+    retryable_status_codes = (429, 500, 502, 503, 504)
+    push_attempts = 3
+    # delay before the n-th retry is min(retry_max_delay, retry_base_delay * 2 ** n) seconds
+    retry_base_delay = 0.5
+    retry_max_delay = 8
+    # Line only allows up to 5 messages per push_message API call
+    max_messages_per_push = 5
+    # how long, in seconds, to wait for more messages to fill up a push
+    push_batch_window = 0.3
+
+    @staticmethod
+    def is_retryable(err):
+        """ Tells whether the given LineBotApiError is a rate limit or server error,
+            i.e. whether pushing the same messages again later may succeed.
+        """
+        if err.status_code in LineCarbot.retryable_status_codes:
+            return True
+        message = str(getattr(err.error, 'message', '')).lower()
+        return 'rate limit' in message or 'quota' in message
 
 class DiscordCarbot(discord.Client):
     token = os.environ['DISCORD_TOKEN']
@@ -43,17 +181,117 @@ class DiscordCarbot(discord.Client):
     # this bot should ignore messages from that bot or else it becomes an infinite feedback
     friend_bot_id = int(os.environ['DISCORD_FRIEND_BOT_ID'])
     target_channel = 'line'
+    # maximum number of attachments downloaded at the same time,
+    # to keep the Discord CDN happy
+    max_concurrent_downloads = 5
+    # attachments larger than this many bytes are spooled to disk instead of kept in memory
+    max_in_memory_attachment_size = 2 * 1024 * 1024
+    download_chunk_size = 64 * 1024
+    # seconds close() waits for background tasks, e.g. Twitch subscriptions, before cancelling them
+    background_task_close_timeout = 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # http session shared by every attachment download and Twitch subscription,
+        # created lazily so that it binds to the running event loop
+        self._session = None
+        # guild id => the guild's channel named target_channel,
+        # kept up to date by the guild and channel events below
+        self._target_channels = {}
+        # Line SendMessage objects waiting to be pushed, drained by flush_line_messages,
+        # queued as one list per Discord message so that a push never splits a Discord message
+        # with another one; a None in the queue tells the flusher to push what it has and stop
+        self._line_queue = asyncio.Queue()
+        self._line_flusher = None
+        # set by close(), messages forwarded from then on are pushed right away
+        self._closing = False
+        # fire and forget tasks, referenced here so that they are not garbage collected while running
+        self._background_tasks = set()
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=64, limit_per_host=16, ttl_dns_cache=300,
+                                               enable_cleanup_closed=True),
+                timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    async def close(self):
+        self._closing = True
+        if self._line_flusher is not None and not self._line_flusher.done():
+            # let the flusher push everything queued before the sentinel,
+            # including the batch it may be holding on to, before it stops
+            self._line_queue.put_nowait(None)
+            await self._line_flusher
+
+        # in case the flusher was never started, push whatever is still queued up so that it is not lost
+        while not self._line_queue.empty():
+            messages = self._line_queue.get_nowait()
+            if messages is not None:
+                await self.push_now(messages)
+
+        # these use the session, so they have to be done before it is closed
+        if self._background_tasks:
+            _, pending = await asyncio.wait(self._background_tasks,
+                                            timeout=DiscordCarbot.background_task_close_timeout)
+            for task in pending:
+                logger.warning('Cancelling background task %s while closing', task)
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+        await super().close()
+
+    def refresh_target_channel(self, guild):
+        channel = discord.utils.find(lambda channel: str(channel) == self.target_channel, guild.channels)
+        if channel is None:
+            self._target_channels.pop(guild.id, None)
+        else:
+            self._target_channels[guild.id] = channel
+
+    async def on_ready(self):
+        self._target_channels.clear()
+        for guild in self.guilds:
+            self.refresh_target_channel(guild)
+
+        # on_ready fires again after reconnects, only one flusher should be running
+        if self._line_flusher is None:
+            self._line_flusher = self.loop.create_task(self.flush_line_messages())
+
+    async def on_guild_join(self, guild):
+        self.refresh_target_channel(guild)
+
+    async def on_guild_remove(self, guild):
+        self._target_channels.pop(guild.id, None)
+
+    async def on_guild_available(self, guild):
+        # the guild was unavailable at on_ready, or its channels were rebuilt after an outage
+        self.refresh_target_channel(guild)
 
+    async def on_guild_unavailable(self, guild):
+        self._target_channels.pop(guild.id, None)
+
+    async def on_guild_channel_create(self, channel):
+        self.refresh_target_channel(channel.guild)
+
+    async def on_guild_channel_delete(self, channel):
+        self.refresh_target_channel(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        self.refresh_target_channel(after.guild)
 
     async def on_member_update(self, before, after):
-        dest_channel = discord.utils.find(lambda channel: str(channel) == self.target_channel, after.guild.channels)
+        dest_channel = self._target_channels.get(after.guild.id)
         if dest_channel is None:
             return
 
         if isinstance(after.activity, discord.Streaming) and not isinstance(before.activity, discord.Streaming):
             # user is currently streaming but not before
-            # let's broadcast it
-            TwitchBroadcastAnnouncer.subscribe(after.activity.twitch_name)
+            # let's broadcast it, without holding up other events while the request is in flight
+            session = await self._get_session()
+            task = self.loop.create_task(TwitchBroadcastAnnouncer.subscribe(session, after.activity.twitch_name))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
 
     async def on_message(self, message):
         if isinstance(message.channel, discord.DMChannel):
@@ -69,8 +307,9 @@ class DiscordCarbot(discord.Client):
     async def broadcast_from_private_channel(self, message):
         # only look at guilds that the author belongs in,
         # so that no random/malicious person can send message to our Line counterpart
-        for guild in filter(lambda guild: message.author in guild.members, self.guilds):
-            dest_channel = discord.utils.find(lambda channel: str(channel) == self.target_channel, guild.channels)
+        # get_member is a dict lookup, unlike scanning guild.members
+        for guild in filter(lambda guild: guild.get_member(message.author.id) is not None, self.guilds):
+            dest_channel = self._target_channels.get(guild.id)
             if dest_channel is None:
                 continue
 
@@ -78,74 +317,182 @@ class DiscordCarbot(discord.Client):
                 await dest_channel.send(content=message.content)
 
             if message.attachments:
-                async with aiohttp.ClientSession() as client:
-                    for attachment in message.attachments:
-                        async with client.get(attachment['url']) as r:
-                            await dest_channel.send(destination=dest_channel, 
-                                                    file=discord.File(r.content, filename=attachment['filename'])
-                                                    )
+                session = await self._get_session()
+                semaphore = asyncio.Semaphore(DiscordCarbot.max_concurrent_downloads)
+                # download all attachments at once, but send them in the order they were attached
+                results = await asyncio.gather(*[ self.download_attachment(session, semaphore, attachment)
+                                                  for attachment in message.attachments ],
+                                               return_exceptions=True)
+                downloads = []
+                for attachment, result in zip(message.attachments, results):
+                    if isinstance(result, BaseException):
+                        # a failed download shouldn't keep the other attachments from being sent
+                        logger.error('Unable to download attachment %s: %r', attachment['filename'], result)
+                    else:
+                        downloads.append((attachment['filename'], result))
+
+                try:
+                    for filename, buffer in downloads:
+                        await dest_channel.send(file=discord.File(buffer, filename=filename))
+                finally:
+                    for _, buffer in downloads:
+                        buffer.close()
             # this message shall be forwarded to line too, 
             # through another on_message event with author = self.user
 
-            logger.info('user {m.author} sent a message with content:\n'
-                        '{m.content}\n'
-                        'and attachments(filenames only):\n'
-                        '{filenames}'.format(m=message, filenames=str([a['filename'] for a in message.attachments])))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('user %s sent a message with content:\n'
+                            '%s\n'
+                            'and attachments(filenames only):\n'
+                            '%s', message.author, message.content, [a['filename'] for a in message.attachments])
 
 
+    async def download_attachment(self, session, semaphore, attachment):
+        """ Downloads the attachment into a file object positioned at its start.
+            The caller is responsible for closing it.
+        """
+        # NOTE: SpooledTemporaryFile is not an io.IOBase before Python 3.11,
+        #       so aiohttp can't upload it there. Roll over from BytesIO by hand instead.
+        buffer = io.BytesIO()
+        try:
+            async with semaphore:
+                async with session.get(attachment['url']) as r:
+                    # an error page is not the attachment, fail like any other download error
+                    r.raise_for_status()
+                    async for chunk in r.content.iter_chunked(DiscordCarbot.download_chunk_size):
+                        if (isinstance(buffer, io.BytesIO) and
+                                buffer.tell() + len(chunk) > DiscordCarbot.max_in_memory_attachment_size):
+                            # attachment is too large to keep in memory, move it to disk
+                            file = tempfile.TemporaryFile()
+                            file.write(buffer.getvalue())
+                            buffer.close()
+                            buffer = file
+                        buffer.write(chunk)
+        except BaseException:
+            buffer.close()
+            raise
+
+        buffer.seek(0)
+        return buffer
+
     async def forward_message(self, message):
         transforms = [ self.text_message, self.attachments ]
         # each transform function returns a list, this line flattens the list of lists into a single list,
         # e.g. flatten([ [a], [b, c] ]) => [a, b, c]
         # it is set up this way because one Discord message can contain multiple attachments,
         # so that one transform function can return more than one Line SendMessage object
-        messages = reduce(operator.add, [ T(message) for T in transforms ], [])
-        
-        # Line only allows up to 5 messages per push_message API call,
-        # let's split the message array into bite-size subarrays in case there are more than
-        # 5 messages in the original array.
-
-        for grouped_messages in group(messages, 5):
-            try:
-                logger.info('Sending a message to group with id {group_id}:\n{messages}'
-                            .format(group_id=str(LineCarbot.target_group_id),
-                                    messages=str(grouped_messages)))
-                LineCarbot.api.push_message(LineCarbot.target_group_id, grouped_messages)
-            except LineBotApiError as err:
-                logger.error('LineBotApiError raised:\n{error}'
-                             .format(error=str(err)))
-
-    """ Regex that matches an emoji string, in its text form.
-
-        An emoji is of the form: <:(emoji name):(emoji hash)>.
-        For example, <:crown:408166031022882816> is a valid emoji
+        messages = list(chain.from_iterable(T(message) for T in transforms))
+        if not messages:
+            return
 
-        Captures the emoji hash.
+        if self._closing:
+            # the flusher is stopping or gone, nothing would take these off the queue
+            await self.push_now(messages)
+            return
 
-        Discord seems to sanitize messages so we don't have to worry about 
-        having message content in this form but is not an emoji.
-    """
-    emoji_regex = re.compile(r'<:[^:]+:([0-9]+)>')
+        # the messages are not pushed right away, flush_line_messages batches them
+        # together with messages from other Discord messages sent around the same time
+        self._line_queue.put_nowait(messages)
 
-    """ Regex that matches a message with just emojis, in its text form.
+    async def push_now(self, messages):
+        """ Pushes the given messages to Line without waiting for a batch to fill up. """
+        try:
+            for grouped_messages in group(messages, LineCarbot.max_messages_per_push):
+                logger.info('Sending a message to group with id %s:\n%s',
+                            LineCarbot.target_group_id, grouped_messages)
+                await self.push_with_retry(grouped_messages)
+        except Exception:
+            logger.exception('Unable to push messages to Line')
+
+    async def flush_line_messages(self):
+        """ Pushes queued up messages to Line until a None is queued by close().
+
+            After the first Discord message of a push arrives, waits up to push_batch_window
+            seconds for more, so that a burst of Discord messages is pushed in as few
+            push_message API calls as possible. Only whole Discord messages are put in a push.
+        """
+        stopping = False
+        # a Discord message that didn't fit in the previous push
+        held = None
+        while held is not None or not stopping:
+            if held is not None:
+                batch, held = [ held ], None
+            else:
+                messages = await self._line_queue.get()
+                if messages is None:
+                    return
+                batch = [ messages ]
+
+            count = len(batch[0])
+            deadline = self.loop.time() + LineCarbot.push_batch_window
+
+            while not stopping and count < LineCarbot.max_messages_per_push:
+                if not self._line_queue.empty():
+                    messages = self._line_queue.get_nowait()
+                else:
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        messages = await asyncio.wait_for(self._line_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if messages is None:
+                    # push the batch we already have before stopping
+                    stopping = True
+                elif count + len(messages) > LineCarbot.max_messages_per_push:
+                    held = messages
+                    break
+                else:
+                    batch.append(messages)
+                    count += len(messages)
 
-        A message that contains just emojis is a message such that there is no
-        non-emoji text in the content, except whitespaces.
-        For example, "<:rock:408166560826654730> <:crown:408166031022882816>"
-        matches this regex.
-    """
-    plain_emoji_msg_regex = re.compile(r'^(?:\s*<:[^:]+:[0-9]+>\s*)+$')
+            try:
+                await self.push_batch(batch)
+            except Exception:
+                # keep the flusher alive, later messages should still make it to Line
+                logger.exception('Unable to push messages to Line')
+
+    async def push_batch(self, batch):
+        """ Pushes the Line messages of one or more Discord messages, given as a list of lists.
+
+            Line accepts or rejects a push as a whole, so if it rejects a push spanning several
+            Discord messages, each of them is pushed again on its own; that way only the
+            Discord message Line doesn't like is lost.
+        """
+        if len(batch) == 1:
+            await self.push_now(batch[0])
+            return
 
-    """ Regex that matches a url.
-        
-        This is needed since URLs sent in a flex message will not appear in
-        Line as a clickable link, nor is it copiable, which is extremely
-        inconvenient as the user will eventually need to open Discord to open
-        the link, which defeats the whole purpose of the bot.
+        messages = list(chain.from_iterable(batch))
+        logger.info('Sending a message to group with id %s:\n%s',
+                    LineCarbot.target_group_id, messages)
+        err = await self.push_with_retry(messages)
+        if err is not None and not LineCarbot.is_retryable(err):
+            logger.info('Pushing the %s Discord messages of the rejected push one by one', len(batch))
+            for messages in batch:
+                await self.push_now(messages)
+
+    async def push_with_retry(self, messages):
+        """ Pushes the given messages to Line, retrying on transient errors.
+            Returns None on success, or the LineBotApiError the push finally failed with.
+        """
+        for attempt in range(LineCarbot.push_attempts):
+            try:
+                await self.loop.run_in_executor(LineCarbot.executor,
+                                                partial(LineCarbot.api.push_message,
+                                                        LineCarbot.target_group_id, messages))
+                return None
+            except LineBotApiError as err:
+                if not LineCarbot.is_retryable(err) or attempt + 1 == LineCarbot.push_attempts:
+                    logger.error('LineBotApiError raised:\n%s', err)
+                    return err
 
-        Credits goes to gruber @ https://gist.github.com/gruber/8891611
-    """
-    url_regex = re.compile(r'''(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))''')
+                delay = min(LineCarbot.retry_max_delay, LineCarbot.retry_base_delay * 2 ** attempt)
+                logger.info('Push to Line failed with status %s, retrying in %s seconds',
+                            err.status_code, delay)
+                await asyncio.sleep(delay)
 
     def text_message(self, message):
         if message.author.bot:
@@ -157,29 +504,25 @@ class DiscordCarbot(discord.Client):
             # don't show name if the message was sent by this bot
             message_author = avatar = []
         else:
-            # message_author is one line of string (no wrap) that has the author name 
-            # with a color as displayed in Discord
-            message_author = [ TextComponent(text=str(message.author.display_name), weight='bold', flex=0, 
-                                             color=str(message.author.color), size='sm') ]
+            # components are cached per author, as the same people keep on talking
+            message_author = [ author_name_component(str(message.author.display_name), str(message.author.color)) ]
             # avatar is an image placed on the left of the message_box
-            # NOTE: avatar_url gives a webp format which Line doesn't know how to deal with.
-            #       Let's just guess the png file name from the user id and avatar hash.
-            #       default_avatar_url is a png so no guessing is needed.
-            avatar = [ ImageComponent(url=message.author.default_avatar_url if not message.author.avatar else
-                                          'https://cdn.discordapp.com/avatars/{0.id}/{0.avatar}.png?size=256'.format(message.author),
-                                      flex=0, size='xxs') ]
+            avatar = [ avatar_component(message.author.id, message.author.avatar,
+                                        None if message.author.avatar else str(message.author.default_avatar_url)) ]
 
         message_body_boxes = []
+        # bot messages are either sent as plain text or contain only emojis, so they never need the urls
+        urls = [] if message.author.bot else find_urls(str(message.content))
+        emojis = find_plain_emojis(str(message.content))
 
         if not message.content:
             # message is empty, 
             # since Line doesn't like TextComponent with an empty string,
             # let's just use a filler so that it looks empty
             message_body_boxes.append(FillerComponent())
-        elif DiscordCarbot.plain_emoji_msg_regex.match(message.content):
+        elif emojis:
             # message contains only emojis and no other text except whitespaces,
             # let's use icons as the message
-            emojis = DiscordCarbot.emoji_regex.findall(message.content)
             if len(emojis) <= 10:
                 # one line can fit 6 emojis at 3xl size
                 group_size, icon_size = 6, '3xl'
@@ -192,8 +535,13 @@ class DiscordCarbot(discord.Client):
                 group_size, icon_size = 10, 'xl'
 
             for emojis_per_line in group(emojis, group_size):
-                line_contents = [IconComponent(url='https://cdn.discordapp.com/emojis/{}.png'.format(emoji), size=icon_size) for emoji in emojis_per_line]
+                line_contents = [ emoji_icon_component(emoji, icon_size) for emoji in emojis_per_line ]
                 message_body_boxes.append(BoxComponent(layout='baseline', contents=line_contents))
+        elif urls and not message.author.bot and not url_regex.sub('', str(message.content)).strip():
+            # message contains only urls and no other text except whitespaces, from a user,
+            # a flex card would just repeat the urls, so let's send the author name followed by the urls
+            return ([ TextSendMessage(text='{}:'.format(message.author.display_name)) ] +
+                    [ TextSendMessage(text=str(url)) for url in urls ])
         elif message.author.bot:
             # message is a normal text message, from a bot,
             # let's not use flex because we are not adding avatar and nickname to the message
@@ -216,14 +564,17 @@ class DiscordCarbot(discord.Client):
 
         return ([ FlexSendMessage(alt_text='{author}:{body}'.format(author=message.author.display_name, body=message.content),
                                   contents=message_card_bubble) ] + 
-                [ TextSendMessage(text=str(url)) for url in DiscordCarbot.url_regex.findall(str(message.content)) ])
+                [ TextSendMessage(text=str(url)) for url in urls ])
 
     def attachments(self, message):
         transformed_attachments = []
         
         for attachment in message.attachments:
-            guessed_type, _ = mimetypes.guess_type(attachment.filename)
-            if guessed_type.startswith('image/'):
+            guessed_type = guess_mimetype(os.path.splitext(attachment.filename)[1].lower())
+            if guessed_type is None:
+                logger.info('Unknown attachment mimetype, from filename %s.', attachment.filename)
+
+            elif guessed_type.startswith('image/'):
                 transformed_attachments.append(ImageSendMessage(original_content_url=attachment.url, preview_image_url=attachment.proxy_url))
 
             elif guessed_type.startswith('audio/'):
@@ -233,6 +584,6 @@ class DiscordCarbot(discord.Client):
                 transformed_attachments.append(VideoSendMessage(original_content_url=attachment.url))
 
             else:
-                logger.info('Unhandleable attachment mimetype {}, guessed from filename {}.'.format(guessed_type, attachment.filename))
+                logger.info('Unhandleable attachment mimetype %s, guessed from filename %s.', guessed_type, attachment.filename)
 
         return transformed_attachments
@@ -1,36 +1,147 @@
 #!/usr/bin/python3
 
+import asyncio
+import atexit
 import logging
-import logging.config
-import sys
-import os
+import logging.handlers
+import queue
+import random
+import signal
 from carbot import DiscordCarbot
 
-LOGGING_CONFIG = None
-logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': False,
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-        },
-    },
-    'loggers': {
-        'carbot': {
-            'level': 'INFO',
-            'handlers': ['console']
-        },
-    },
-})
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that leaves formatting, tracebacks included, to the listener thread.
+
+        The stock QueueHandler formats every record before queueing it so that the record
+        can be pickled, but our queue never leaves this process.
+    """
+    def prepare(self, record):
+        return record
+
+def configure_logging():
+    """ Sets up the carbot logger, the only place the logging tree is configured.
+        Does nothing if logging has already been configured.
+    """
+    # the flag lives on the logging module rather than in this one, so that it is seen
+    # even if this file is imported a second time under another name than __main__
+    if getattr(logging, '_carbot_configured', False):
+        return
+    logging._carbot_configured = True
+
+    # records are only put on this queue by the event loop thread,
+    # formatting and writing them out is done by log_listener on its own thread
+    log_queue = queue.Queue(maxsize=10000)
+    # records are written out 100 at a time, or right away together with anything buffered once an error is logged
+    log_buffer = logging.handlers.MemoryHandler(100, flushLevel=logging.ERROR, target=logging.StreamHandler())
+    log_listener = logging.handlers.QueueListener(log_queue, log_buffer, respect_handler_level=True)
+
+    queue_handler = DeferredQueueHandler(log_queue)
+
+    carbot_logger = logging.getLogger('carbot')
+    carbot_logger.setLevel(logging.INFO)
+    carbot_logger.addHandler(queue_handler)
+    carbot_logger.propagate = False
+
+    # discord.py logs every heartbeat and http request at lower levels, we only care about problems
+    logging.getLogger('discord').setLevel(logging.WARNING)
+    logging.getLogger('websockets').setLevel(logging.WARNING)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.WARNING)
+    root_logger.addHandler(queue_handler)
+
+    # nothing in the log format uses these, so don't collect them for every record;
+    # clearing _srcfile also skips the stack walk that finds the caller's file and line
+    logging.logProcesses = False
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    logging._srcfile = None
+
+    log_listener.start()
+    # atexit runs these in reverse, so the listener hands over its last records before the buffer is flushed
+    atexit.register(log_buffer.flush)
+    atexit.register(log_listener.stop)
+
+logger = logging.getLogger('carbot')
+
+# after the n-th consecutive crash, wait min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** n) seconds,
+# plus up to RESTART_JITTER seconds, before starting the bot again
+RESTART_BASE_DELAY = 1
+RESTART_MAX_DELAY = 900
+RESTART_JITTER = 1
+
+async def supervise(token):
+    """ Runs a DiscordCarbot, replacing it with a new one whenever it crashes,
+        until one stops without an exception or the process is asked to stop.
+    """
+    failures = 0
+    bot = None
+    # task closing the current bot, so that it is closed only once however many times it is asked to
+    closing = None
+    stopping = asyncio.Event()
+
+    async def reset_failures_when_ready(bot):
+        nonlocal failures
+        await bot.wait_until_ready()
+        failures = 0
+
+    def close_bot():
+        nonlocal closing
+        if closing is None:
+            closing = asyncio.ensure_future(bot.close())
+        return closing
+
+    def stop():
+        # closing the bot lets it say goodbye to the gateway, and makes bot.start return below
+        stopping.set()
+        if bot is not None:
+            close_bot()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop)
+        except NotImplementedError:
+            # signal handlers are not supported by the event loop on Windows
+            pass
+
+    while not stopping.is_set():
+        bot = DiscordCarbot()
+        closing = None
+        ready_waiter = asyncio.ensure_future(reset_failures_when_ready(bot))
+        try:
+            await bot.start(token)
+            return
+        except Exception:
+            logger.exception('Caught exception')
+        finally:
+            ready_waiter.cancel()
+            # waits for the close started by stop() if there is one, rather than closing a second time
+            await close_bot()
+
+        # restart on the same event loop instead of re-executing the process,
+        # backing off so that a persistent failure doesn't hammer the Discord gateway
+        delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** min(failures, 10)) + random.uniform(0, RESTART_JITTER)
+        failures += 1
+        try:
+            await asyncio.wait_for(stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
 def main():
+    configure_logging()
+
+    try:
+        # uvloop is optional, the bot runs just as well on the default event loop without it
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     try:
-        DiscordCarbot().run(DiscordCarbot.token)
+        asyncio.run(supervise(DiscordCarbot.token))
     except SystemExit:
         pass
-    except Exception as e:
-        logging.getLogger('carbot').error('Caught exception: ' + str(e))
-        os.execv(__file__, sys.argv)
 
 
 if __name__ == '__main__':